@@ -23,18 +23,13 @@ A simulation framework for complex systems modelling and analysis.
 from __future__ import division
 from .__version__ import __version__
 
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib import animation
-import pyglet
+import numpy as np
+import collections
+import importlib
 import os
-
-try:
-    from io import BytesIO as StringIO
-except ImportError:
-    from cStringIO import StringIO
+import sys
+import threading
+import time
 
 __docformat__ = 'restructuredtext'
 __author__ = 'Tiago Baptista'
@@ -42,28 +37,105 @@ __author__ = 'Tiago Baptista'
 # Variable to determine if we are being imported by readthedocs autobuild
 on_rtd = os.environ.get('READTHEDOCS') == 'True'
 
+# Variable to determine if we are running without a display server (e.g. batch
+# runs on a remote machine). In this case pyglet must not create its hidden
+# shadow window, as there is no display to connect to.
+headless = os.environ.get('SIMCX_HEADLESS') == 'True'
+
 
 class Simulator(object):
+    # Subclasses that set the dirty flag themselves whenever their state
+    # changes should set this to True. Otherwise, the simulator is considered
+    # dirty after every step.
+    track_dirty = False
+
     def __init__(self):
         self.dirty = True
 
     def step(self, delta=0):
         assert False, "Not implemented!"
 
+    def advance(self, n, delta=0):
+        """Step the simulation `n` times. Subclasses may override this with a
+        faster implementation than calling :meth:`step` in a loop."""
+        for _ in range(n):
+            self.step(delta)
+
     def reset(self):
         assert False, "Not implemented!"
 
 
-class PyafaiSimulator(Simulator):
-    def __init__(self, world):
-        super(PyafaiSimulator, self).__init__()
+class Timings(object):
+    """Records the wall time taken by named tasks (e.g. the step of a
+    simulator, or the draw of a visual), keeping the last `size` samples of
+    each task."""
 
-        self.world = world
-        self.world.paused = False
-        pyglet.clock.unschedule(self.world._start_schedule)
+    def __init__(self, size=100):
+        self.size = size
+        self._samples = collections.OrderedDict()
+        self._lock = threading.Lock()
 
-    def step(self, delta=0):
-        self.world.update(delta)
+    def add(self, name, seconds):
+        with self._lock:
+            if name not in self._samples:
+                self._samples[name] = collections.deque(maxlen=self.size)
+            self._samples[name].append(seconds)
+
+    def time(self, name):
+        """Return a context manager that records the time spent inside it
+        under `name`."""
+        return _Timer(self, name)
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Return a dictionary with, for each task, the number of samples,
+        and the mean, maximum and given percentiles of their times, in
+        seconds."""
+
+        with self._lock:
+            samples = [(name, list(values))
+                       for name, values in self._samples.items()]
+
+        result = collections.OrderedDict()
+        for name, values in samples:
+            stats = {'n': len(values), 'mean': float(np.mean(values)),
+                     'max': float(np.max(values))}
+            for p, value in zip(percentiles,
+                                np.percentile(values, percentiles)):
+                stats['p{}'.format(p)] = float(value)
+            result[name] = stats
+
+        return result
+
+    def report(self):
+        """Return a table with the summary of the times, in milliseconds."""
+
+        lines = ['{:<32} {:>8} {:>8} {:>8} {:>8}'.format('task', 'mean',
+                                                        'p50', 'p90', 'p99')]
+        for name, stats in self.summary().items():
+            lines.append('{:<32} {:8.2f} {:8.2f} {:8.2f} {:8.2f}'.format(
+                name[:32], 1000 * stats['mean'], 1000 * stats['p50'],
+                1000 * stats['p90'], 1000 * stats['p99']))
+
+        return '\n'.join(lines)
+
+    def dump(self, file=None):
+        print(self.report(), file=file or sys.stdout)
+
+
+class _Timer(object):
+    def __init__(self, timings, name):
+        self._timings = timings
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self._timings.add(self._name, time.perf_counter() - self._start)
 
 
 class Visual(object):
@@ -76,262 +148,29 @@ class Visual(object):
         assert False, "Not implemented!"
 
 
-class MplVisual(Visual):
-    def __init__(self, sim: Simulator, **kwargs):
-        super(MplVisual, self).__init__(sim, width=kwargs.get('width', 500),
-                                        height=kwargs.get('height', 500))
-
-        self.dpi = 80
-        self.figure = plt.figure(figsize=(self.width/self.dpi,
-                                          self.height/self.dpi),
-                                 dpi=self.dpi)
-        self._create_canvas()
-
-    def _create_canvas(self):
-        self.canvas = FigureCanvas(self.figure)
-        data = StringIO()
-        self.canvas.print_raw(data)
-        self.image = pyglet.image.ImageData(self.width, self.height,
-                                            'RGBA', data.getvalue(),
-                                            -4 * self.width)
+# Names provided by the display module. That module, and the visuals module,
+# need pyglet and matplotlib, so they are only imported when first used. This
+# way, simulators can be used without those packages (e.g. in worker
+# processes), and without paying for their import.
+_display_names = ('PyafaiSimulator', 'MplVisual', 'PyafaiVisual', 'Display',
+                  'SimulationThread', 'BatchRunner', 'FFMpegWriter',
+                  'OffscreenWriter', 'ImageSequenceWriter', 'run')
 
-    def update_image(self):
-        data = StringIO()
-        self.canvas.print_raw(data)
-        self.image.set_data('RGBA', -4 * self.width, data.getvalue())
 
+def __getattr__(name):
+    if name in _display_names:
+        return getattr(importlib.import_module('.display', __name__), name)
+    elif name == 'visuals':
+        return importlib.import_module('.visuals', __name__)
 
-class PyafaiVisual(Visual):
-    def __init__(self, sim: PyafaiSimulator, width=500, height=500):
-        self.world = sim.world
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__,
+                                                                   name))
 
-        if hasattr(self.world, 'width'):
-            width = self.world.width
 
-        if hasattr(self.world, 'height'):
-            height = self.world.height
-
-        super(PyafaiVisual, self).__init__(sim, width=width, height=height)
-
-    def draw(self):
-        self.world.draw()
-        self.world.draw_objects()
-
-
-# Prevent readthedocs from using pyglet.window as GLU is not installed there.
-if on_rtd:
-    pyglet_window = object
-else:
-    pyglet_window = pyglet.window.Window
-
-
-class Display(pyglet_window):
-    def __init__(self, width=500, height=500, interval=0.05,
-                 multi_sampling=True, **kwargs):
-
-        if 'caption' not in kwargs:
-            kwargs['caption'] = 'Complex Systems (paused)'
-        else:
-            kwargs['caption'] += ' (paused)'
-
-        if multi_sampling:
-            # Enable multi sampling if available on the hardware
-            display = pyglet.canvas.get_display()
-            screen = display.get_default_screen()
-            template = pyglet.gl.Config(sample_buffers=1, samples=4,
-                                        double_buffer=True)
-            try:
-                config = screen.get_best_config(template)
-            except pyglet.window.NoSuchConfigException:
-                template = pyglet.gl.Config()
-                config = screen.get_best_config(template)
-
-            super(Display, self).__init__(width, height,
-                                          config=config, **kwargs)
-        else:
-            super(Display, self).__init__(width, height,
-                                          **kwargs)
-
-        self.paused = True
-        self.show_fps = False
-        self.real_time = False
-        self._recording = False
-        self._movie_writer = None
-        self._interval = interval
-        self._sims = []
-        self._visuals = []
-        self._pos = []
-
-        self._fps_display = pyglet.window.FPSDisplay(window=self)
-
-        pyglet.clock.schedule_interval(self._update, self._interval)
-
-    def add_simulator(self, sim: Simulator):
-        if sim not in self._sims:
-            self._sims.append(sim)
-
-    def add_visual(self, visual: Visual, x=0, y=0):
-        if visual not in self._visuals:
-            self._visuals.append(visual)
-            self._pos.append((x, y))
-            self._resize_window()
-
-            if isinstance(visual, MplVisual):
-                visual.update_image()
-
-    def start_recording(self, filename='simcx.mp4', fps=None, bitrate=1800):
-        if self._movie_writer is None:
-            if fps is None:
-                fps = 1 // self._interval
-
-            self._movie_writer = FFMpegWriter(fps=fps, bitrate=bitrate)
-            self._movie_writer.setup(self, filename)
-            self._recording = True
-            print("Recording started...")
-        else:
-            print("A movie is already being recorded for this Display.")
-
-    def on_draw(self):
-        # clear window
-        self.clear()
-
-        # draw visuals
-        for i in range(len(self._visuals)):
-            vis = self._visuals[i]
-            if isinstance(vis, MplVisual):
-                vis.image.blit(*self._pos[i])
-            else:
-                pyglet.gl.glPushMatrix()
-                pyglet.gl.glTranslatef(self._pos[i][0], self._pos[i][1], 0)
-                vis.draw()
-                pyglet.gl.glPopMatrix()
-
-        # show fps
-        if self.show_fps:
-            self._fps_display.draw()
-
-    def on_close(self):
-        if self._movie_writer is not None:
-            self._movie_writer.finish()
-
-        super(Display, self).on_close()
-
-    def on_key_press(self, symbol, modifiers):
-        super(Display, self).on_key_press(symbol, modifiers)
-
-        if symbol == pyglet.window.key.S:
-            if self.paused:
-                self._step_simulation(self._interval)
-
-        elif symbol == pyglet.window.key.R:
-            if pyglet.window.key.MOD_ALT & modifiers:
-                self.start_recording()
-            else:
-                if self.paused:
-                    self._reset_simulation()
-
-        elif symbol == pyglet.window.key.SPACE:
-            if self.paused:
-                self.paused = False
-                self.set_caption(self.caption.replace(" (paused)", ""))
-            else:
-                self.paused = True
-                self.set_caption(self.caption + " (paused)")
-        elif symbol == pyglet.window.key.F:
-            self.show_fps = not self.show_fps
-
-    def _draw_gui(self):
-        pass
-
-    def _update(self, dt):
-        if not self.paused:
-            self._step_simulation(dt)
-
-    def _step_simulation(self, dt=None):
-        if self._recording:
-            self._movie_writer.grab_frame()
-
-        if not self.real_time:
-            dt = self._interval
-
-        for sim in self._sims:
-            sim.step(dt)
-
-        for vis in self._visuals:
-            if isinstance(vis, MplVisual):
-                vis.draw()
-                vis.update_image()
-
-    def _reset_simulation(self):
-        for sim in self._sims:
-            sim.reset()
-
-        for vis in self._visuals:
-            if isinstance(vis, MplVisual):
-                vis.draw()
-                vis.update_image()
-
-    def _resize_window(self):
-        max_x = 0
-        max_y = 0
-        for i in range(len(self._visuals)):
-            if self._pos[i][0] + self._visuals[i].width > max_x:
-                max_x = self._pos[i][0] + self._visuals[i].width
-            if self._pos[i][1] + self._visuals[i].height > max_y:
-                max_y = self._pos[i][1] + self._visuals[i].height
-
-        if max_x != self.width or max_y != self.height:
-            self.set_size(max_x, max_y)
-            self.clear()
-
-
-class FFMpegWriter(animation.FFMpegWriter):
-    @property
-    def frame_size(self):
-        """A tuple (width,height) in pixels of a movie frame."""
-
-        return self.display.width, self.display.height
-
-    def setup(self, display, outfile):
-        """
-        Perform setup for writing the movie file.
-        display: `simcx.Display` instance
-        The Display instance whose framebuffer we want to use.
-        outfile: string
-        The filename of the resulting movie file
-        """
-
-        self.outfile = outfile
-        self.display = display
-
-        # Run here so that grab_frame() can write the data to a pipe. This
-        # eliminates the need for temp files.
-        self._run()
-
-    def grab_frame(self, **savefig_kwargs):
-        """
-        Grab the image information from the display and save as a movie frame.
-        The keyword arguments are not being used in the subclass.
-        """
-
-        try:
-            image = pyglet.image.get_buffer_manager().get_color_buffer().get_image_data()
-            self._proc.stdin.write(image.get_data('RGBA',
-                                                  -4 * self.display.width))
-
-        except RuntimeError:
-            out, err = self._proc.communicate()
-            print('MovieWriter -- Error ')
-            print('running proc:\n%s\n%s' % (out, err))
-            raise
-
-
-def run():
-    pyglet.app.run()
+def __dir__():
+    return sorted(list(globals()) + list(_display_names) + ['visuals'])
 
 
 # import sub-modules
 from . import simulators
-from . import visuals
-
-
+from . import ensemble
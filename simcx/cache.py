@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2015-2023 Tiago Baptista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+"""
+This module provides an on-disk cache for the results of simulators that
+take long to compute, such as final state diagrams, so that they can be
+reused across sessions.
+"""
+
+from __future__ import division
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+__docformat__ = 'restructuredtext'
+__author__ = 'Tiago Baptista'
+
+
+class ResultCache(object):
+    """Stores sets of named numpy arrays in `directory`, one subdirectory
+    per key, with one ``.npy`` file per array. Arrays are loaded as read
+    only memory maps, so even large results load instantly. When the cache
+    grows over `max_bytes`, the least recently used entries are removed.
+
+    Keys are made with :meth:`key` from the values that determine the result
+    (e.g. the parameters of a simulator, and the :func:`function_hash` of
+    the functions it uses).
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Return a key made from the hash of all the `parts`, which may be
+        numpy arrays, functions (see :func:`function_hash`), values with a
+        stable repr, or lists, tuples and dictionaries of those."""
+        h = hashlib.sha256()
+        for part in parts:
+            _update(h, part)
+        return h.hexdigest()
+
+    def load(self, key):
+        """Return a dictionary with the arrays stored for `key`, or None if
+        they are not in the cache."""
+        path = os.path.join(self.directory, key)
+        try:
+            arrays = {name[:-4]: np.load(os.path.join(path, name),
+                                         mmap_mode='r')
+                      for name in os.listdir(path) if name.endswith('.npy')}
+            # The modification time tells which entries were used last
+            os.utime(path)
+        except OSError:
+            # Missing, or removed by another process
+            return None
+
+        return arrays
+
+    def save(self, key, **arrays):
+        """Store the given arrays for `key`. If `key` is already in the cache,
+        nothing is done."""
+        path = os.path.join(self.directory, key)
+        if os.path.exists(path):
+            return
+
+        # Write to a temporary directory first, so that other processes never
+        # see incomplete entries
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), array)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Saved by another process in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache uses at
+        most `max_bytes`."""
+        entries = []
+        total = 0
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+            except OSError:
+                continue
+            total += size
+
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Remove all the entries."""
+        for key in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, key),
+                          ignore_errors=True)
+
+
+def function_hash(func):
+    """Return a hash of the code of `func`, including its default argument
+    values and the values of its closure. Globals used by `func` are not
+    included. Functions with no Python code (e.g. numpy ufuncs) are
+    identified by their repr."""
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return ResultCache.key(repr(func))
+
+    closure = [cell.cell_contents for cell in func.__closure__ or ()]
+    return ResultCache.key(_code_parts(code), func.__defaults__,
+                           func.__kwdefaults__, closure)
+
+
+def _update(h, part):
+    # Arrays are hashed by their contents, as their repr is truncated
+    if isinstance(part, np.ndarray):
+        h.update('{}{}'.format(part.dtype.str, part.shape).encode())
+        h.update(np.ascontiguousarray(part).tobytes())
+    elif isinstance(part, (list, tuple)):
+        h.update('{}{}'.format(type(part).__name__, len(part)).encode())
+        for item in part:
+            _update(h, item)
+    elif isinstance(part, dict):
+        h.update('dict{}'.format(len(part)).encode())
+        for key, value in part.items():
+            _update(h, key)
+            _update(h, value)
+    elif callable(part) and hasattr(part, '__code__'):
+        h.update(function_hash(part).encode())
+    else:
+        h.update(repr(part).encode())
+    h.update(b'\0')
+
+
+def _code_parts(code):
+    # Nested functions, lambdas and comprehensions have their own code objects
+    consts = tuple(_code_parts(const) if hasattr(const, 'co_code') else const
+                   for const in code.co_consts)
+    return code.co_code, consts, code.co_names, code.co_varnames
@@ -0,0 +1,886 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2015-2023 Tiago Baptista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+"""
+This module provides the components of the framework that need pyglet and
+matplotlib: the matplotlib and pyafai visuals, the :class:`Display` window,
+the :class:`BatchRunner`, and the movie writers. These are also available
+from the :mod:`simcx` package.
+
+"""
+
+from __future__ import division
+from . import Simulator, Timings, Visual, on_rtd, headless
+import matplotlib as mpl
+mpl.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from matplotlib import animation
+import numpy as np
+import pyglet
+import queue
+import threading
+import time
+
+__docformat__ = 'restructuredtext'
+__author__ = 'Tiago Baptista'
+
+if headless:
+    pyglet.options['shadow_window'] = False
+
+
+class PyafaiSimulator(Simulator):
+    def __init__(self, world):
+        super(PyafaiSimulator, self).__init__()
+
+        self.world = world
+        self.world.paused = False
+        pyglet.clock.unschedule(self.world._start_schedule)
+
+    def step(self, delta=0):
+        self.world.update(delta)
+
+
+class MplVisual(Visual):
+    def __init__(self, sim: Simulator, **kwargs):
+        super(MplVisual, self).__init__(sim, width=kwargs.get('width', 500),
+                                        height=kwargs.get('height', 500))
+
+        self.dpi = 80
+        self.figure = plt.figure(figsize=(self.width/self.dpi,
+                                          self.height/self.dpi),
+                                 dpi=self.dpi)
+        self.blit = kwargs.get('blit', False)
+        self._animated = []
+        self._background = None
+        self._limits = None
+        self._create_canvas()
+
+    def _create_canvas(self):
+        self.canvas = FigureCanvas(self.figure)
+        # The texture is only created when first needed, so that visuals can
+        # be used without a window (see BatchRunner).
+        self.image = None
+
+    def add_animated(self, *artists):
+        """Register matplotlib artists that change on every draw. When
+        blitting is enabled, only these artists are rendered on each frame, on
+        top of a cached background with the rest of the figure."""
+        for artist in artists:
+            if self.blit:
+                artist.set_animated(True)
+            self._animated.append(artist)
+
+    def invalidate_background(self):
+        """Force a full render of the figure on the next frame. Only needed
+        when static elements other than the axes limits are changed."""
+        self._background = None
+
+    def rasterise(self):
+        """Render the figure into the RGBA buffer of the Agg canvas."""
+        if not self.blit or not self._animated:
+            self.canvas.draw()
+            return
+
+        # Render the static background again only if the axes limits changed
+        limits = self._get_limits()
+        if self._background is None or limits != self._limits:
+            self.canvas.draw()
+            self._background = self.canvas.copy_from_bbox(self.figure.bbox)
+            self._limits = limits
+        else:
+            self.canvas.restore_region(self._background)
+
+        for artist in self._animated:
+            self.figure.draw_artist(artist)
+
+    def _get_limits(self):
+        return [(ax.get_xlim(), ax.get_ylim()) for ax in self.figure.axes]
+
+    def update_image(self):
+        self.rasterise()
+        self._upload_image()
+
+    def _upload_image(self):
+        # The Agg buffer is uploaded straight into a persistent texture, with
+        # no intermediate copies into python bytes objects.
+        buffer = np.asarray(self.canvas.buffer_rgba())
+        height, width = buffer.shape[:2]
+
+        if self.image is None:
+            texture = pyglet.image.Texture.create(width, height,
+                                                  rectangle=True)
+            # Agg stores rows from top to bottom, so flip the texture
+            self.image = texture.get_transform(flip_y=True)
+            self.image.anchor_y = 0
+
+        gl = pyglet.gl
+        gl.glBindTexture(self.image.target, self.image.id)
+        gl.glTexSubImage2D(self.image.target, 0, self.image.x, self.image.y,
+                           width, height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+                           buffer.ctypes.data)
+
+
+class PyafaiVisual(Visual):
+    def __init__(self, sim: PyafaiSimulator, width=500, height=500):
+        self.world = sim.world
+
+        if hasattr(self.world, 'width'):
+            width = self.world.width
+
+        if hasattr(self.world, 'height'):
+            height = self.world.height
+
+        super(PyafaiVisual, self).__init__(sim, width=width, height=height)
+
+    def draw(self):
+        self.world.draw()
+        self.world.draw_objects()
+
+
+# Prevent readthedocs from using pyglet.window as GLU is not installed there.
+if on_rtd:
+    pyglet_window = object
+else:
+    pyglet_window = pyglet.window.Window
+
+
+class Display(pyglet_window):
+    """A window that steps the registered simulators and shows their
+    visuals.
+
+    Every `interval` seconds the simulators are stepped `steps_per_frame`
+    times. If `frame_rate` is given, the visuals are rendered at most that
+    many times per second, independently of the simulation, and frames are
+    skipped when rendering falls behind. Otherwise, the visuals are rendered
+    after every simulation update.
+
+    If `threaded` is True, the simulators are stepped in a
+    :class:`SimulationThread`, so that slow simulators do not block drawing
+    and input handling.
+
+    The time taken by each simulator step, visual draw, rasterisation and
+    recording is kept in `timings` (see :class:`Timings`), and can be shown
+    on screen with the T key.
+    """
+
+    def __init__(self, width=500, height=500, interval=0.05,
+                 multi_sampling=True, steps_per_frame=1, frame_rate=None,
+                 threaded=False, **kwargs):
+
+        if 'caption' not in kwargs:
+            kwargs['caption'] = 'Complex Systems (paused)'
+        else:
+            kwargs['caption'] += ' (paused)'
+
+        if multi_sampling:
+            # Enable multi sampling if available on the hardware
+            display = pyglet.canvas.get_display()
+            screen = display.get_default_screen()
+            template = pyglet.gl.Config(sample_buffers=1, samples=4,
+                                        double_buffer=True)
+            try:
+                config = screen.get_best_config(template)
+            except pyglet.window.NoSuchConfigException:
+                template = pyglet.gl.Config()
+                config = screen.get_best_config(template)
+
+            super(Display, self).__init__(width, height,
+                                          config=config, **kwargs)
+        else:
+            super(Display, self).__init__(width, height,
+                                          **kwargs)
+
+        self.paused = True
+        self.show_fps = False
+        self.show_timings = False
+        self.real_time = False
+        self.timings = Timings()
+        self._recording = False
+        self._movie_writer = None
+        self._interval = interval
+        self._steps_per_frame = steps_per_frame
+        self._frame_rate = frame_rate
+        self._next_frame = 0
+        self._stepped = False
+        self._sims = []
+        self._visuals = []
+        self._pos = []
+
+        # Held while the simulators are stepped, and while visuals read their
+        # state. Simulators whose changes were drawn by the matplotlib visuals
+        # while the lock was busy are kept in _undrawn, for the other visuals.
+        self._lock = threading.Lock()
+        self._undrawn = []
+        # The last image drawn by each visual that is not a matplotlib visual
+        self._snapshots = {}
+        # Cleared while a frame could not take the lock. A simulation thread
+        # then waits for the next frame between steps, so that slow steps do
+        # not keep the visuals from ever being refreshed.
+        self._drawn = threading.Event()
+        self._drawn.set()
+
+        self._fps_display = pyglet.window.FPSDisplay(window=self)
+        self._timings_label = pyglet.text.Label('', font_name='monospace',
+                                                font_size=9, multiline=True,
+                                                width=400, anchor_y='top')
+        self._timings_updated = 0
+
+        if threaded:
+            # The clock is then only used to trigger redraws
+            if frame_rate is not None:
+                self._frame_interval = 1 / frame_rate
+            else:
+                self._frame_interval = self._interval
+            pyglet.clock.schedule_interval(self._update, self._frame_interval)
+            self._thread = SimulationThread(self)
+            self._thread.start()
+        else:
+            self._thread = None
+            pyglet.clock.schedule_interval(self._update, self._interval)
+
+    def add_simulator(self, sim: Simulator):
+        if sim not in self._sims:
+            self._sims.append(sim)
+
+    def add_visual(self, visual: Visual, x=0, y=0):
+        if visual not in self._visuals:
+            self._visuals.append(visual)
+            self._pos.append((x, y))
+            self._resize_window()
+
+            if isinstance(visual, MplVisual):
+                visual.update_image()
+
+    def start_recording(self, filename='simcx.mp4', fps=None, bitrate=1800,
+                        queue_size=8, policy='block'):
+        if self._movie_writer is None:
+            if fps is None:
+                if self._frame_rate is not None:
+                    fps = self._frame_rate
+                else:
+                    fps = 1 // self._interval
+
+            self._movie_writer = FFMpegWriter(fps=fps, bitrate=bitrate,
+                                              queue_size=queue_size,
+                                              policy=policy)
+            self._movie_writer.setup(self, filename)
+            self._recording = True
+            print("Recording started...")
+        else:
+            print("A movie is already being recorded for this Display.")
+
+    def on_draw(self):
+        start = time.perf_counter()
+
+        # clear window
+        self.clear()
+
+        # A simulation thread may hold the lock for a long step, and the
+        # window must not wait for it. So the lock is only taken if it is
+        # free. Otherwise, the matplotlib visuals show their last images.
+        render = False
+        changed = []
+        updated = []
+        if self._lock.acquire(blocking=False):
+            try:
+                render = self._frame_due()
+                if render:
+                    # Matplotlib visuals whose simulator has changed copy its
+                    # state while the simulators are locked. These copies are
+                    # then rasterised without the lock, so that a simulation
+                    # thread can compute the next state.
+                    sims = _all_simulators(self._sims, self._visuals)
+                    changed = [sim for sim in sims if sim.dirty]
+                    for i in range(len(self._visuals)):
+                        vis = self._visuals[i]
+                        if isinstance(vis, MplVisual) and _is_dirty(vis):
+                            with self.timings.time('draw ' + _label(vis, i)):
+                                vis.draw()
+                            updated.append(i)
+                    _clear_dirty(self._sims, self._visuals)
+            finally:
+                self._lock.release()
+
+            self._drawn.set()
+        else:
+            self._drawn.clear()
+
+        for i in updated:
+            vis = self._visuals[i]
+            with self.timings.time('rasterise ' + _label(vis, i)):
+                vis.rasterise()
+            with self.timings.time('upload ' + _label(vis, i)):
+                vis._upload_image()
+
+        locked = self._lock.acquire(blocking=False)
+        try:
+            # The other visuals must see the changes already drawn above,
+            # including those of frames where the lock was busy, but these
+            # must not hide any changes made since.
+            shown = []
+            if locked:
+                shown = [sim for sim in self._undrawn + changed
+                         if not sim.dirty]
+                self._undrawn = []
+                for sim in shown:
+                    sim.dirty = True
+            else:
+                self._undrawn.extend(changed)
+
+            # draw visuals. Those that are not matplotlib visuals read the
+            # state of their simulator as they draw to the window. So they
+            # are only drawn with the lock, and a copy of what they drew is
+            # shown again while the lock is busy.
+            for i in range(len(self._visuals)):
+                vis = self._visuals[i]
+                if isinstance(vis, MplVisual):
+                    vis.image.blit(*self._pos[i])
+                elif locked:
+                    pyglet.gl.glPushMatrix()
+                    pyglet.gl.glTranslatef(self._pos[i][0], self._pos[i][1],
+                                           0)
+                    with self.timings.time('draw ' + _label(vis, i)):
+                        vis.draw()
+                    pyglet.gl.glPopMatrix()
+                    self._snapshot(i)
+                elif vis in self._snapshots:
+                    self._snapshots[vis].blit(*self._pos[i])
+
+            # show fps
+            if self.show_fps:
+                self._fps_display.draw()
+
+            if self.show_timings:
+                self._draw_timings()
+
+            if locked:
+                if render:
+                    if self._recording and self._stepped:
+                        with self.timings.time('grab'):
+                            self._movie_writer.grab_frame()
+                    self._stepped = False
+
+                # all visuals have now seen the changes to the simulators
+                for sim in shown:
+                    sim.dirty = False
+        finally:
+            if locked:
+                self._lock.release()
+
+        self.timings.add('frame', time.perf_counter() - start)
+
+    def on_close(self):
+        if self._thread is not None:
+            self._thread.stop()
+
+        if self._movie_writer is not None:
+            self._movie_writer.finish()
+            print("Recording finished: {frames_written} frames written, "
+                  "{frames_dropped} dropped.".format(
+                      **self._movie_writer.stats()))
+
+        super(Display, self).on_close()
+
+    def on_key_press(self, symbol, modifiers):
+        super(Display, self).on_key_press(symbol, modifiers)
+
+        if symbol == pyglet.window.key.S:
+            if self.paused:
+                self._step_simulation(self._interval)
+
+        elif symbol == pyglet.window.key.R:
+            if pyglet.window.key.MOD_ALT & modifiers:
+                self.start_recording()
+            else:
+                if self.paused:
+                    self._reset_simulation()
+
+        elif symbol == pyglet.window.key.SPACE:
+            if self.paused:
+                self.paused = False
+                self.set_caption(self.caption.replace(" (paused)", ""))
+            else:
+                self.paused = True
+                self.set_caption(self.caption + " (paused)")
+        elif symbol == pyglet.window.key.F:
+            self.show_fps = not self.show_fps
+        elif symbol == pyglet.window.key.T:
+            self.show_timings = not self.show_timings
+
+    def _draw_gui(self):
+        pass
+
+    def _snapshot(self, index):
+        # Copy the region of the window of a visual into its texture, on
+        # the GPU
+        vis = self._visuals[index]
+        texture = self._snapshots.get(vis)
+        if (texture is None or texture.width != vis.width or
+                texture.height != vis.height):
+            texture = pyglet.image.Texture.create(vis.width, vis.height)
+            self._snapshots[vis] = texture
+
+        gl = pyglet.gl
+        gl.glBindTexture(texture.target, texture.id)
+        buffer = pyglet.image.get_buffer_manager().get_color_buffer()
+        x, y = self._pos[index]
+        region = buffer.get_region(x, y, vis.width, vis.height)
+        region.blit_to_texture(texture.target, texture.level, 0, 0, 0)
+
+    def _draw_timings(self):
+        # The text layout is slow, so only update it twice per second
+        now = time.time()
+        if now - self._timings_updated > 0.5:
+            self._timings_label.text = self.timings.report()
+            self._timings_updated = now
+
+        self._timings_label.y = self.height
+        self._timings_label.draw()
+
+    def _update(self, dt):
+        if not self.paused and self._thread is None:
+            self._step_simulation(dt)
+
+    def _frame_due(self):
+        if self._frame_rate is None:
+            return True
+
+        now = time.time()
+        if now < self._next_frame:
+            return False
+
+        # Skip the missed frames if rendering is falling behind
+        self._next_frame += 1 / self._frame_rate
+        if self._next_frame < now:
+            self._next_frame = now + 1 / self._frame_rate
+
+        return True
+
+    def _step_simulation(self, dt=None):
+        if not self.real_time:
+            dt = self._interval
+
+        # The lock is released between steps, so that the visuals can be
+        # drawn while a batch of slow steps is running.
+        for _ in range(self._steps_per_frame):
+            with self._lock:
+                for i in range(len(self._sims)):
+                    sim = self._sims[i]
+                    with self.timings.time('step ' + _label(sim, i)):
+                        sim.step(dt)
+                    if not sim.track_dirty:
+                        sim.dirty = True
+
+                self._stepped = True
+
+            if threading.current_thread() is self._thread:
+                self._drawn.wait(2 * self._frame_interval)
+
+    def _reset_simulation(self):
+        with self._lock:
+            for sim in self._sims:
+                sim.reset()
+                sim.dirty = True
+
+    def _resize_window(self):
+        max_x = 0
+        max_y = 0
+        for i in range(len(self._visuals)):
+            if self._pos[i][0] + self._visuals[i].width > max_x:
+                max_x = self._pos[i][0] + self._visuals[i].width
+            if self._pos[i][1] + self._visuals[i].height > max_y:
+                max_y = self._pos[i][1] + self._visuals[i].height
+
+        if max_x != self.width or max_y != self.height:
+            self.set_size(max_x, max_y)
+            self.clear()
+
+
+class SimulationThread(threading.Thread):
+    """Steps the simulators of a :class:`Display` in a background thread.
+
+    The simulators are updated every `interval` seconds of the display, or as
+    soon as possible if an update takes longer than that. The display lock is
+    held during each step, and while visuals copy the state of the simulators
+    at draw time, so each frame shows a consistent state. The display never
+    waits for the lock: while a step is running, it shows the last images of
+    its visuals, and the thread lets the next frame take the lock before
+    stepping again. Simulators that spend most of their time in numpy
+    (or other code that releases the GIL) then run in parallel with the
+    rendering of the previous state.
+    """
+
+    def __init__(self, display):
+        super(SimulationThread, self).__init__()
+        self.daemon = True
+        self.display = display
+        self._stop_event = threading.Event()
+
+    def run(self):
+        interval = self.display._interval
+        last = next_update = time.time()
+        while not self._stop_event.is_set():
+            if self.display.paused:
+                self._stop_event.wait(max(interval, 0.01))
+                last = next_update = time.time()
+                continue
+
+            now = time.time()
+            self.display._step_simulation(now - last)
+            last = now
+
+            next_update += interval
+            delay = next_update - time.time()
+            if delay > 0:
+                self._stop_event.wait(delay)
+            else:
+                # Do not try to catch up with missed updates
+                next_update = time.time()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class BatchRunner(object):
+    """Runs simulators as fast as possible, without a window.
+
+    Simulators and visuals are registered in the same way as for a
+    :class:`Display`, but the simulation is not tied to the pyglet clock.
+    Matplotlib visuals are rendered every `render_every` steps, or never if
+    `render_every` is 0. Other visuals need an OpenGL context, and are
+    ignored. Set the ``SIMCX_HEADLESS`` environment variable to ``True`` to
+    use the runner on machines without a display server.
+
+    The rendered frames can be recorded to a movie, or to a sequence of
+    images, with :meth:`start_recording`. The time taken by each task is kept
+    in `timings`, as for a :class:`Display`.
+    """
+
+    def __init__(self, interval=0.05, render_every=0):
+        self.render_every = render_every
+        self.steps = 0
+        self.timings = Timings()
+        self.width = 0
+        self.height = 0
+        self._interval = interval
+        self._movie_writer = None
+        self._sims = []
+        self._visuals = []
+        self._pos = []
+
+    def add_simulator(self, sim: Simulator):
+        if sim not in self._sims:
+            self._sims.append(sim)
+
+    def add_visual(self, visual: Visual, x=0, y=0):
+        if visual not in self._visuals:
+            self._visuals.append(visual)
+            self._pos.append((x, y))
+            self.width = max(self.width, x + visual.width)
+            self.height = max(self.height, y + visual.height)
+
+            if isinstance(visual, MplVisual):
+                visual.rasterise()
+
+    def start_recording(self, filename='simcx.mp4', fps=20, bitrate=1800):
+        """Record every rendered frame. If `filename` contains a format
+        field, e.g. ``'frame_{:05d}.png'``, each frame is saved as an image
+        named with its number. Otherwise, the frames are written to a movie
+        file with ffmpeg."""
+
+        if self._movie_writer is None:
+            if '{' in filename:
+                self._movie_writer = ImageSequenceWriter()
+            else:
+                self._movie_writer = OffscreenWriter(fps=fps, bitrate=bitrate)
+            self._movie_writer.setup(self, filename)
+        else:
+            print("A movie is already being recorded for this BatchRunner.")
+
+    def stop_recording(self):
+        if self._movie_writer is not None:
+            self._movie_writer.finish()
+            self._movie_writer = None
+
+    def composite(self):
+        """Return the last rendered frame of the matplotlib visuals as an
+        RGBA array, laid out as they would be in a :class:`Display`."""
+
+        frame = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+        frame[:, :, 3] = 255
+
+        for i in range(len(self._visuals)):
+            vis = self._visuals[i]
+            if isinstance(vis, MplVisual):
+                buffer = np.asarray(vis.canvas.buffer_rgba())
+                height, width = buffer.shape[:2]
+                # The position of the visual is given from the bottom left
+                x = self._pos[i][0]
+                y = self.height - self._pos[i][1] - height
+                frame[y:y + height, x:x + width] = buffer
+
+        return frame
+
+    def run(self, steps=None, until=None):
+        """Step the simulation `steps` times, or until the callable `until`
+        returns True. `until` receives this runner as its only argument, and
+        is checked before each step. Returns the number of steps taken."""
+
+        if steps is None and until is None:
+            raise ValueError("Either steps or until must be given.")
+
+        n = 0
+        while steps is None or n < steps:
+            if until is not None and until(self):
+                break
+            self.step()
+            n += 1
+
+        return n
+
+    def step(self):
+        for i in range(len(self._sims)):
+            sim = self._sims[i]
+            with self.timings.time('step ' + _label(sim, i)):
+                sim.step(self._interval)
+            if not sim.track_dirty:
+                sim.dirty = True
+        self.steps += 1
+
+        if self.render_every and self.steps % self.render_every == 0:
+            self.render()
+
+    def reset(self):
+        for sim in self._sims:
+            sim.reset()
+            sim.dirty = True
+        self.steps = 0
+
+    def render(self):
+        for i in range(len(self._visuals)):
+            vis = self._visuals[i]
+            if isinstance(vis, MplVisual) and _is_dirty(vis):
+                with self.timings.time('draw ' + _label(vis, i)):
+                    vis.draw()
+                with self.timings.time('rasterise ' + _label(vis, i)):
+                    vis.rasterise()
+
+        _clear_dirty(self._sims, self._visuals)
+
+        if self._movie_writer is not None:
+            with self.timings.time('grab'):
+                self._movie_writer.grab_frame()
+
+
+class FFMpegWriter(animation.FFMpegWriter):
+    """Writes the frames of a :class:`Display` to a movie file with ffmpeg.
+
+    Frames are read into a pool of `queue_size` preallocated buffers, and
+    written to ffmpeg by a separate thread, so that a slow ffmpeg does not
+    stall the simulation. When all the buffers are waiting to be written,
+    `policy` decides whether to wait for the writer (``'block'``) or to drop
+    the new frame (``'drop'``).
+    """
+
+    def __init__(self, fps=5, bitrate=None, queue_size=8, policy='block',
+                 **kwargs):
+        super(FFMpegWriter, self).__init__(fps=fps, bitrate=bitrate, **kwargs)
+
+        if policy not in ('block', 'drop'):
+            raise ValueError("Unknown policy: {}".format(policy))
+
+        self.queue_size = queue_size
+        self.policy = policy
+        self.frames_grabbed = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self._error = None
+
+    @property
+    def frame_size(self):
+        """A tuple (width,height) in pixels of a movie frame. It is the size
+        of the display when the movie was set up, even if the display was
+        resized since."""
+
+        return self._frame_size
+
+    def setup(self, display, outfile):
+        """
+        Perform setup for writing the movie file.
+        display: `simcx.Display` instance
+        The Display instance whose framebuffer we want to use.
+        outfile: string
+        The filename of the resulting movie file
+        """
+
+        self.outfile = outfile
+        self.display = display
+
+        # The buffers, and ffmpeg, expect frames of this size
+        self._frame_size = display.width, display.height
+        width, height = self._frame_size
+        self._free = queue.Queue()
+        for _ in range(self.queue_size):
+            self._free.put(np.empty((height, width, 4), dtype=np.uint8))
+        self._frames = queue.Queue()
+
+        # Run here so that grab_frame() can write the data to a pipe. This
+        # eliminates the need for temp files.
+        self._run()
+
+        self._writer = threading.Thread(target=self._write_frames)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def grab_frame(self, **savefig_kwargs):
+        """
+        Grab the image information from the display and queue it to be saved
+        as a movie frame.
+        The keyword arguments are not being used in the subclass.
+        """
+
+        if self._error is not None:
+            print('MovieWriter -- Error ')
+            raise RuntimeError(self._error)
+
+        try:
+            buffer = self._free.get(block=self.policy == 'block')
+        except queue.Empty:
+            self.frames_dropped += 1
+            return
+
+        width, height = self._frame_size
+        gl = pyglet.gl
+        gl.glReadBuffer(gl.GL_BACK)
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        gl.glReadPixels(0, 0, width, height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+                        buffer.ctypes.data)
+
+        self.frames_grabbed += 1
+        self._frames.put(buffer)
+
+    def finish(self):
+        """Write all the queued frames and finish the movie file."""
+
+        self._frames.put(None)
+        self._writer.join()
+        super(FFMpegWriter, self).finish()
+
+    def stats(self):
+        """Return a dictionary with the number of frames grabbed, written,
+        dropped, and waiting to be written."""
+
+        return {'frames_grabbed': self.frames_grabbed,
+                'frames_written': self.frames_written,
+                'frames_dropped': self.frames_dropped,
+                'frames_queued': self._frames.qsize()}
+
+    def _write_frames(self):
+        while True:
+            buffer = self._frames.get()
+            if buffer is None:
+                break
+
+            try:
+                if self._error is None:
+                    # OpenGL rows go from bottom to top
+                    self._proc.stdin.write(buffer[::-1].tobytes())
+                    self.frames_written += 1
+            except (OSError, ValueError) as e:
+                self._error = e
+            finally:
+                self._free.put(buffer)
+
+
+class OffscreenWriter(animation.FFMpegWriter):
+    """Writes the frames of a :class:`BatchRunner` to a movie file with
+    ffmpeg. Frames are composed from the buffers of the matplotlib visuals,
+    so no window or OpenGL context is needed."""
+
+    @property
+    def frame_size(self):
+        """A tuple (width,height) in pixels of a movie frame."""
+
+        return self.runner.width, self.runner.height
+
+    def setup(self, runner, outfile):
+        """
+        Perform setup for writing the movie file.
+        runner: `simcx.BatchRunner` instance
+        The BatchRunner whose visuals we want to record.
+        outfile: string
+        The filename of the resulting movie file
+        """
+
+        self.outfile = outfile
+        self.runner = runner
+        self._run()
+
+    def grab_frame(self, **savefig_kwargs):
+        """
+        Compose the current frame of the runner and save it as a movie frame.
+        The keyword arguments are not being used in the subclass.
+        """
+
+        self._proc.stdin.write(self.runner.composite().data)
+
+
+class ImageSequenceWriter(object):
+    """Saves the frames of a :class:`BatchRunner` as a sequence of image
+    files. The output filename must contain a format field for the frame
+    number, e.g. ``'frame_{:05d}.png'``."""
+
+    def setup(self, runner, outfile):
+        self.outfile = outfile
+        self.runner = runner
+        self.frame = 0
+
+    def grab_frame(self):
+        plt.imsave(self.outfile.format(self.frame), self.runner.composite())
+        self.frame += 1
+
+    def finish(self):
+        pass
+
+
+def run():
+    pyglet.app.run()
+
+
+def _label(obj, index):
+    return '{} {}'.format(type(obj).__name__, index)
+
+
+def _is_dirty(visual):
+    # Visuals without a simulator are always redrawn
+    return visual.sim is None or visual.sim.dirty
+
+
+def _all_simulators(sims, visuals):
+    # Simulators shown by a visual may not have been added to the display
+    result = list(sims)
+    for vis in visuals:
+        if vis.sim is not None and vis.sim not in result:
+            result.append(vis.sim)
+    return result
+
+
+def _clear_dirty(sims, visuals):
+    for sim in _all_simulators(sims, visuals):
+        sim.dirty = False
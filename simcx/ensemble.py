@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2015-2023 Tiago Baptista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+"""
+This module provides a way to run many independent instances of a simulator
+(an ensemble), for example with different parameters or random seeds, using
+all the cores of the machine.
+"""
+
+from __future__ import division
+from concurrent.futures import ProcessPoolExecutor
+from operator import attrgetter
+import random
+import numpy as np
+
+__docformat__ = 'restructuredtext'
+__author__ = 'Tiago Baptista'
+
+
+class Ensemble(object):
+    """Runs one simulator for each value in `params`, in a pool of processes,
+    and collects the values of the given observables.
+
+    Simulators are created by calling ``factory(param, rng)``, where `rng` is
+    a :class:`numpy.random.Generator` with an independent random stream for
+    each member, derived from `seed`. The global random states of numpy and of
+    the random module are also seeded from that stream, for simulators that
+    use them directly, so runs are reproducible.
+
+    `observables` maps names to either attribute names of the simulator
+    (e.g. ``'y'``) or functions that receive the simulator and return a
+    value. The values of each observable must have the same shape for all
+    the members, and over time if they are recorded. As the factory and the
+    observables are sent to other processes, they must be defined at the
+    module level (or be an :func:`operator.attrgetter`).
+    """
+
+    def __init__(self, factory, params, observables, seed=None):
+        self.factory = factory
+        self.params = list(params)
+        self.observables = {}
+        for name, observable in observables.items():
+            if isinstance(observable, str):
+                observable = attrgetter(observable)
+            self.observables[name] = observable
+
+        # One seed for each random generator of each member
+        self._seeds = [member.spawn(3) for member in
+                       np.random.SeedSequence(seed).spawn(len(self.params))]
+
+    def run(self, steps, record_every=0, interval=0.05, processes=None):
+        """Step every member `steps` times, and return a dictionary with an
+        array for each observable. The first axis of each array is the
+        member. If `record_every` is 0, only the final value of each
+        observable is kept. Otherwise, the values are recorded every
+        `record_every` steps (including the initial state), along a second
+        axis. `processes` is the size of the process pool (by default, the
+        number of cores). With 1 process, members run in this process.
+        """
+
+        tasks = [(self.factory, param, seed, self.observables, steps,
+                  record_every, interval)
+                 for param, seed in zip(self.params, self._seeds)]
+
+        if processes == 1:
+            results = [_run_member(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(processes) as executor:
+                results = list(executor.map(_run_member, tasks))
+
+        return {name: _stack(name, [result[name] for result in results])
+                for name in self.observables}
+
+
+def _run_member(task):
+    factory, param, seed, observables, steps, record_every, interval = task
+
+    rng_seed, numpy_seed, random_seed = seed
+    np.random.seed(numpy_seed.generate_state(1)[0])
+    random.seed(int(random_seed.generate_state(1)[0]))
+    sim = factory(param, np.random.default_rng(rng_seed))
+
+    records = {name: [] for name in observables}
+    stride = record_every or max(steps, 1)
+    for i in range(0, steps, stride):
+        if record_every:
+            for name, observable in observables.items():
+                records[name].append(np.array(observable(sim)))
+        sim.advance(min(stride, steps - i), interval)
+
+    for name, observable in observables.items():
+        if not record_every or steps % record_every == 0:
+            records[name].append(np.array(observable(sim)))
+
+    if record_every:
+        return {name: _stack(name, values) for name, values in records.items()}
+    else:
+        return {name: values[0] for name, values in records.items()}
+
+
+def _stack(name, values):
+    shapes = set(value.shape for value in values)
+    if len(shapes) > 1:
+        raise ValueError(
+            "Observable {!r} must have the same shape for every member and "
+            "record, but has shapes {}. Instead of observables that grow "
+            "over time (e.g. the y of a FunctionIterator), use a function "
+            "that returns a value of fixed size (e.g. the last "
+            "state).".format(name, sorted(shapes)))
+
+    return np.stack(values)
@@ -24,7 +24,8 @@ should not be considered stable in terms of API.
 
 from __future__ import division
 from . import MplVisual, Simulator, Visual
-from .simulators import FunctionIterator, FunctionIterator2D, FinalStateIterator
+from .simulators import (FunctionIterator, FunctionIterator2D,
+                         FinalStateIterator, IFS)
 import numpy as np
 import pyglet
 import matplotlib as mpl
@@ -45,6 +46,7 @@ class Line(MplVisual):
 
         self.ax = self.figure.add_subplot(111)
         self.l, = self.ax.plot(self._x, self._y)
+        self.add_animated(self.l)
 
     def draw(self):
         self.l.set_data(self._x, self._y)
@@ -64,6 +66,7 @@ class Lines(MplVisual):
         for i in range(len(self.sim.y)):
             line, = self.ax.plot(self.sim.x, self.sim.y[i])
             self._lines.append(line)
+        self.add_animated(*self._lines)
 
     def draw(self):
         for i in range(len(self._lines)):
@@ -91,6 +94,12 @@ class PhaseSpace2D(Line):
         self.ax.set_xlabel(name_x)
         self.ax.set_ylabel(name_y)
 
+    def draw(self):
+        # The trajectory arrays of the simulator are replaced as they grow
+        self._x = self.sim.y[0]
+        self._y = self.sim.y[1]
+        super(PhaseSpace2D, self).draw()
+
 
 class CobWebVisual(MplVisual):
     def __init__(self, sim: FunctionIterator, min_x, max_x, func_string='',
@@ -109,44 +118,73 @@ class CobWebVisual(MplVisual):
         self.ax.plot(x, x, ':k', label='$f(x)=x$')
 
         # Create initial cobweb plots
-        self._cobx = [[x[0]] for x in self.sim.y]
-        self._coby = [[0] for x in self.sim.y]
+        self._cobx = [[x] for x in self.sim.initial_states]
+        self._coby = [[0] for x in self.sim.initial_states]
         self._cobweb_lines = []
         for i in range(len(self.sim.y)):
             line, = self.ax.plot(self._cobx[i], self._coby[i],
-                                 label='$x_0=' + str(self.sim.y[i][0]) + '$')
+                                 label='$x_0=' +
+                                       str(self.sim.initial_states[i]) + '$')
             self._cobweb_lines.append(line)
 
+        # Time of the last state in the plot. Several steps may have been
+        # taken since the last draw.
+        self._last_time = 0
+
     def draw(self):
+        times = self.sim.x
+        if times[-1] < self._last_time:
+            # The simulator was reset
+            self._cobx = [[x] for x in self.sim.initial_states]
+            self._coby = [[0] for x in self.sim.initial_states]
+            self._last_time = 0
+
+        first = max(np.searchsorted(times, self._last_time, side='right'), 1)
         for i in range(len(self._cobweb_lines)):
-            self._cobx[i].append(self.sim.y[i][-2])
-            self._coby[i].append(self.sim.y[i][-2])
-            self._cobx[i].append(self.sim.y[i][-2])
-            self._coby[i].append(self.sim.y[i][-1])
+            y = self.sim.y[i]
+            for j in range(first, len(times)):
+                self._cobx[i].append(y[j - 1])
+                self._coby[i].append(y[j - 1])
+                self._cobx[i].append(y[j - 1])
+                self._coby[i].append(y[j])
 
             self._cobweb_lines[i].set_data(self._cobx[i], self._coby[i])
 
+        self._last_time = times[-1]
+
 
 class FinalStateDiagram(MplVisual):
     def __init__(self, sim: FunctionIterator, discard_initial=1000, **kwargs):
         super(FinalStateDiagram, self).__init__(sim, **kwargs)
 
         self._discard_initial = discard_initial
-        self._seeds = [y[0] for y in self.sim.y]
+        self._seeds = self.sim.initial_states[:]
 
         self.ax = self.figure.add_subplot(111)
         self.ax.set_title('Final State Diagram')
-        x_min = min([y[0] for y in self.sim.y])
-        x_max = max([y[0] for y in self.sim.y])
+        x_min = min(self._seeds)
+        x_max = max(self._seeds)
         self.ax.set_xlim(x_min - 0.5, x_max + 0.5)
         self.ax.set_xlabel('$t={}$'.format(self.sim.time))
         self.ax.set_ylabel('Final Value(s)')
 
+        # Time of the first state not yet in the plot
+        self._next_time = self._discard_initial
+
     def draw(self):
         self.ax.set_xlabel('$t={}$'.format(self.sim.time))
-        if self.sim.time >= self._discard_initial:
+        times = self.sim.x
+        if times[-1] < self._next_time - 1:
+            # The simulator was reset
+            self._next_time = self._discard_initial
+
+        if times[-1] >= self._next_time:
+            new = times >= self._next_time
             for i in range(len(self.sim.y)):
-                self.ax.scatter([self._seeds[i]], self.sim.y[i][-1:], c='black')
+                values = self.sim.y[i][new]
+                self.ax.scatter([self._seeds[i]] * len(values), values,
+                                c='black')
+            self._next_time = times[-1] + 1
 
 
 class BifurcationDiagram(MplVisual):
@@ -161,8 +199,17 @@ class BifurcationDiagram(MplVisual):
         self.ax.set_ylim(kwargs.get('ymin', 0), kwargs.get('ymax', 1))
         self.ax.grid()
 
+        self._n_drawn = 0
+
     def draw(self):
-        self.ax.scatter(self.sim.x, self.sim.y, s=0.5, c='black')
+        # Plot all the parameter values computed since the last draw
+        n = self.sim.n_computed
+        if n > self._n_drawn:
+            params = self.sim.params[self._n_drawn:n]
+            data = self.sim.data[self._n_drawn:n]
+            self.ax.scatter(np.repeat(params, data.shape[1]), data.ravel(),
+                            s=0.5, c='black')
+            self._n_drawn = n
 
 
 class Points2D(Visual):
@@ -179,11 +226,17 @@ class Points2D(Visual):
         if self.sim.draw_points:
             points = self.sim.draw_points
 
-            for i in range(len(points)):
-                self._batch.add(1, pyglet.gl.GL_POINTS, None, ('v2f', points[i]),
-                                ('c3B', (255, 255, 255)))
+            # Entries are either single points or (k, 2) blocks of points.
+            # Only the entries seen here are removed, as a simulation thread
+            # may add more in the meantime.
+            n = len(points)
+            for i in range(n):
+                block = np.asarray(points[i], dtype=np.float32).reshape(-1, 2)
+                self._batch.add(len(block), pyglet.gl.GL_POINTS, None,
+                                ('v2f', block.ravel()),
+                                ('c3B', (255, 255, 255) * len(block)))
 
-            self.sim.draw_points.clear()
+            del points[:n]
 
         pyglet.gl.glPushMatrix()
         pyglet.gl.glScalef(self._scale_x, self._scale_y, 1.)
@@ -192,12 +245,47 @@ class Points2D(Visual):
         pyglet.gl.glPopMatrix()
 
 
+class Density2D(MplVisual):
+    """Shows the `data` of a simulator with a 2D histogram (e.g. an
+    :class:`~simcx.simulators.IFS` in histogram mode) as an image of the
+    region given by its `bounds`, in log scale if `log` is True."""
+
+    def __init__(self, sim: IFS, log=True, **kwargs):
+        super(Density2D, self).__init__(sim, **kwargs)
+
+        self.ax = self.figure.add_axes([0, 0, 1, 1])
+        self.ax.set_axis_off()
+        if log:
+            norm = mpl.colors.LogNorm(vmin=1, vmax=10)
+        else:
+            norm = mpl.colors.Normalize(vmin=0, vmax=1)
+        self._image = self.ax.imshow(self.sim.data, origin='lower',
+                                     extent=self.sim.bounds, aspect='auto',
+                                     interpolation='nearest',
+                                     cmap=kwargs.get('cmap', 'hot'),
+                                     norm=norm)
+        # Empty cells are not drawn in log scale
+        self.figure.set_facecolor(self._image.cmap(0))
+
+    def draw(self):
+        self._image.set_data(self.sim.data)
+        # Keep the initial limits until there are any counts
+        if self.sim.data.max() > 0:
+            self._image.set_clim(self._image.norm.vmin, self.sim.data.max())
+
+
 class FractalVisual(MplVisual):
     def __init__(self, sim, gamma=1.0, **kwargs):
         super(FractalVisual, self).__init__(sim, **kwargs)
 
         norm = mpl.colors.PowerNorm(gamma)
 
-        self.figure.figimage(self.sim.data, cmap=kwargs.get('cmap', 'hot'),
-                             norm=norm)
+        self._image = self.figure.figimage(self.sim.data,
+                                           cmap=kwargs.get('cmap', 'hot'),
+                                           norm=norm)
+
+    def draw(self):
+        self._image.set_data(self.sim.data)
+        # The data may change over time (e.g. with a progressive JuliaSet)
+        self._image.autoscale()
 